@@ -1,10 +1,12 @@
-import pyarrow.parquet as pq
 import pandas as pd
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 from shiny import App, Inputs, Outputs, Session, reactive, render, req, ui
 from shinywidgets import output_widget, render_widget
-from scipy.stats import linregress
+from scipy.stats import t as t_dist
+from collections import OrderedDict
+from datastore import data_version, data_versions, read_columns
+from itertools import product
 import numpy as np
 
 genes = pd.read_csv("DETECTED_GENES.csv", header=None, index_col=False)
@@ -73,6 +75,138 @@ color_map = {
     'Old Male Astrocytes': "#4839c9"
 }
 
+# Group keys are small integer codes over the (age, sex, line) product, with
+# one extra "any" level per factor for groupings that leave it out. Labels
+# and colors are resolved once here and indexed by code.
+group_levels = ([*ages, None], [*sexes, None], [*lines, None])
+group_labels = np.array([" ".join(p for p in parts if p) for parts in product(*group_levels)], dtype=object)
+group_colors = np.array([color_map.get(label) for label in group_labels], dtype=object)
+
+def group_codes(data, age=False, sex=False, line=False):
+    """Integer group code per row, combining only the requested factors."""
+    age_code = data["AGE"].cat.codes.to_numpy(dtype=np.int16) if age else len(ages)
+    sex_code = data["SEX"].cat.codes.to_numpy(dtype=np.int16) if sex else len(sexes)
+    line_code = data["LINE"].cat.codes.to_numpy(dtype=np.int16) if line else len(lines)
+    return ((age_code * (len(sexes) + 1) + sex_code) * (len(lines) + 1) + line_code).astype(np.int8)
+
+def with_group_labels(data):
+    """Copy of a filtered frame with GROUP codes converted back to labels."""
+    data = data.copy()
+    data["GROUP"] = group_labels[data["GROUP"].to_numpy()]
+    return data
+
+# Fitted correlation trendlines keyed by (dataset, data versions, gene, COMP, group set).
+# Theme and legend changes re-render the plots but reuse these results, and
+# a replaced data file gets a new version so old fits are never served.
+FIT_CACHE_SIZE = 512
+fit_cache = OrderedDict()
+
+def fit_groups(x, y, codes, n_groups, level=0.95):
+    """Fit y against log10(x) for every group code in one vectorized pass.
+
+    Returns one entry per code: None when the group cannot be fit, else a
+    tuple (x_sorted, y_fit, lower, upper) where lower/upper bound the
+    confidence band of the fitted mean (NaN for groups with < 3 points).
+    """
+    lx = np.log10(x)
+    n = np.bincount(codes, minlength=n_groups).astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_x = np.bincount(codes, lx, n_groups) / n
+        mean_y = np.bincount(codes, y, n_groups) / n
+        dx = lx - mean_x[codes]
+        sxx = np.bincount(codes, dx * dx, n_groups)
+        sxy = np.bincount(codes, dx * (y - mean_y[codes]), n_groups)
+        slope = sxy / sxx
+        intercept = mean_y - slope * mean_x
+        resid = y - (slope[codes] * lx + intercept[codes])
+        dof = n - 2
+        s = np.sqrt(np.bincount(codes, resid * resid, n_groups) / dof)
+        tcrit = t_dist.ppf((1 + level) / 2, dof)
+
+        order = np.lexsort((lx, codes))
+        c = codes[order]
+        y_fit = slope[c] * lx[order] + intercept[c]
+        half = tcrit[c] * s[c] * np.sqrt(1 / n[c] + (lx[order] - mean_x[c]) ** 2 / sxx[c])
+
+    # keep regression lines and bands >=0
+    lower = np.maximum(y_fit - half, 0)
+    upper = np.maximum(y_fit + half, 0)
+    y_fit = np.maximum(y_fit, 0)
+
+    bounds = np.cumsum(n.astype(int))[:-1]
+    valid = (n > 1) & (sxx > 0)
+    return [
+        (xs, fit, lo, hi) if valid[i] else None
+        for i, (xs, fit, lo, hi) in enumerate(zip(
+            np.split(x[order], bounds), np.split(y_fit, bounds),
+            np.split(lower, bounds), np.split(upper, bounds)))
+    ]
+
+def correlation_fits(dataset, version, gene, comp, comp_data):
+    """Masked scatter points plus pooled and per-group trendlines for one COMP panel."""
+    groups = tuple(int(g) for g in comp_data["GROUP"].unique())
+    key = (dataset, version, gene, comp, groups)
+    if key in fit_cache:
+        fit_cache.move_to_end(key)
+        return fit_cache[key]
+
+    x = comp_data[f"{gene}_x"].to_numpy(dtype=float)
+    y = comp_data[f"{gene}_y"].to_numpy(dtype=float)
+    codes = comp_data["GROUP"].to_numpy(dtype=np.intp)
+
+    # Remove NaNs and ensure x>0 for log scale, floor y values at 0
+    mask = ~np.isnan(x) & ~np.isnan(y) & (x > 0)
+    x = x[mask]
+    y = np.maximum(y[mask], 0)
+    codes = codes[mask]
+
+    # Pooled line is fit as an extra code holding every point
+    pooled = len(group_labels)
+    trendlines = fit_groups(
+        np.concatenate([x, x]),
+        np.concatenate([y, y]),
+        np.concatenate([codes, np.full(len(codes), pooled)]),
+        pooled + 1
+    )
+    points = [(x[codes == g], y[codes == g]) for g in groups]
+
+    fits = {"groups": groups, "points": points, "group_lines": [trendlines[g] for g in groups], "pooled_line": trendlines[pooled]}
+    fit_cache[key] = fits
+    if len(fit_cache) > FIT_CACHE_SIZE:
+        fit_cache.popitem(last=False)
+    return fits
+
+def add_trendline(fig, line, color, name, show_band, col):
+    x_sorted, y_fit, lower, upper = line
+    if show_band and not np.isnan(lower).all():
+        fig.add_trace(
+            go.Scatter(
+                x=np.concatenate([x_sorted, x_sorted[::-1]]),
+                y=np.concatenate([upper, lower[::-1]]),
+                fill="toself",
+                fillcolor=color,
+                opacity=0.2,
+                line=dict(width=0),
+                hoverinfo="skip",
+                name=name,
+                showlegend=False
+            ),
+            row=1,
+            col=col
+        )
+    fig.add_trace(
+        go.Scatter(
+            x=x_sorted,
+            y=y_fit,
+            mode="lines",
+            line=dict(color=color, width=2),
+            name=name,
+            showlegend=False
+        ),
+        row=1,
+        col=col
+    )
+
 app_ui = ui.page_sidebar(
     ui.sidebar(
         ui.input_selectize(
@@ -129,6 +263,8 @@ app_ui = ui.page_sidebar(
                 selected=lines
             ),
         ),
+        ui.input_checkbox("group_fits", "Per-group trendlines", False),
+        ui.input_checkbox("fit_bands", "Show 95% confidence bands", False),
         ui.download_button("download_expr", "Download Expression Data"),
         ui.download_button("download_gene", "Download Gene Body Modificaiton Data"),
         ui.download_button("download_tss", "Download Promoter Modificaiton Data"),
@@ -165,17 +301,17 @@ app_ui = ui.page_sidebar(
 def server(input: Inputs, output: Outputs, session: Session):
     @render.download(filename="gene_expression_data.csv")
     def download_expr():
-        outData = filtered_expr()
+        outData = with_group_labels(filtered_expr())
         yield outData.to_csv(index=False)
     
     @render.download(filename="gene_body_methylation_data.csv")
     def download_gene():
-        outData = filtered_body()
+        outData = with_group_labels(filtered_body())
         yield outData.to_csv(index=False)
 
     @render.download(filename="promoter_methylation_data.csv")
     def download_tss():
-        outData = filtered_tss()
+        outData = with_group_labels(filtered_tss())
         yield outData.to_csv(index=False)
     
     @reactive.effect
@@ -189,9 +325,18 @@ def server(input: Inputs, output: Outputs, session: Session):
             ui.update_dark_mode("light")
             mode = "light"
     
+    # Re-render when a data file is replaced, and drop fits of old versions
+    @reactive.poll(data_versions, 2)
+    def loaded_versions():
+        versions = data_versions()
+        for key in [key for key in fit_cache if not set(key[1]) <= set(versions)]:
+            del fit_cache[key]
+        return versions
+
     @reactive.Calc
     def filtered_expr() -> pd.DataFrame:
-        data = pq.read_table('ALL_RPKM_LABELED_FILTERED.parquet', columns=["AGE", "SEX", "LINE", input.gene()]).to_pandas()
+        loaded_versions()
+        data = read_columns('ALL_RPKM_LABELED_FILTERED.parquet', ["AGE", "SEX", "LINE", input.gene()])
         data["AGE"] = pd.Categorical(data["AGE"], categories=ages, ordered=True)
         data["SEX"] = pd.Categorical(data["SEX"], categories=sexes, ordered=True)
         data["LINE"] = pd.Categorical(data["LINE"], categories=lines, ordered=True)
@@ -199,36 +344,36 @@ def server(input: Inputs, output: Outputs, session: Session):
         match input.filter():
             case "1":
                 outputData = sorted_data.loc[sorted_data["AGE"].isin(input.age()), ("AGE", "LINE", input.gene())]
-                outputData["GROUP"] = outputData["AGE"]
+                outputData["GROUP"] = group_codes(outputData, age=True)
                 return outputData
             case "2":
                 outputData = sorted_data.loc[sorted_data["SEX"].isin(input.sex()), ("SEX", "LINE", input.gene())]
-                outputData["GROUP"] = outputData["SEX"]
+                outputData["GROUP"] = group_codes(outputData, sex=True)
                 return outputData
             case "3":
                 outputData = sorted_data.loc[sorted_data["LINE"].isin(input.line()), ("LINE", input.gene())]
-                outputData["GROUP"] = outputData["LINE"]
+                outputData["GROUP"] = group_codes(outputData, line=True)
                 return outputData
             case "4":
                 outputData = sorted_data.loc[sorted_data["AGE"].isin(input.age()), ("AGE", "SEX", "LINE", input.gene())]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["SEX"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, age=True, sex=True)
                 return outputData
             case "5":
                 outputData = sorted_data.loc[sorted_data["AGE"].isin(input.age()), ("AGE", "LINE", input.gene())]
                 outputData = outputData.loc[outputData["LINE"].isin(input.line()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["LINE"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, age=True, line=True)
                 return outputData
             case "6":
                 outputData = sorted_data.loc[sorted_data["LINE"].isin(input.line()), ("SEX", "LINE", input.gene())]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
-                outputData["GROUP"] = outputData["SEX"].astype(str) + " " + outputData["LINE"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, sex=True, line=True)
                 return outputData
             case "7":
                 outputData = sorted_data.loc[sorted_data["AGE"].isin(input.age()), ("AGE", "SEX", "LINE", input.gene())]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
                 outputData = outputData.loc[outputData["LINE"].isin(input.line()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["SEX"].astype(str)  + " " + outputData["LINE"].astype(str) 
+                outputData["GROUP"] = group_codes(outputData, age=True, sex=True, line=True)
                 return outputData
 
     @render_widget
@@ -248,7 +393,7 @@ def server(input: Inputs, output: Outputs, session: Session):
         for group in data['GROUP'].unique():
             fig.add_trace(go.Box(y = data[data['GROUP'] == group][input.gene()],
                 boxpoints = 'all', jitter = 0.5, marker_line_width=1, line = dict(width=2),
-                pointpos = 0, name = group, marker_color=color_map[group]))
+                pointpos = 0, name = group_labels[group], marker_color=group_colors[group]))
         fig.update_layout(
             title=input.gene(),
             title_font = dict(
@@ -271,7 +416,8 @@ def server(input: Inputs, output: Outputs, session: Session):
     
     @reactive.Calc
     def filtered_body() -> pd.DataFrame:
-        gene_corr = pq.read_table('ALL_GENE_BODY_PER_SAMPLE_TRANSPOSED_FINAL.parquet', columns=["AGE", "SEX", "LINE", "COMP", input.gene()]).to_pandas()
+        loaded_versions()
+        gene_corr = read_columns('ALL_GENE_BODY_PER_SAMPLE_TRANSPOSED_FINAL.parquet', ["AGE", "SEX", "LINE", "COMP", input.gene()])
         gene_corr["AGE"] = pd.Categorical(gene_corr["AGE"], categories=ages, ordered=True)
         gene_corr["SEX"] = pd.Categorical(gene_corr["SEX"], categories=sexes, ordered=True)
         gene_corr["LINE"] = pd.Categorical(gene_corr["LINE"], categories=lines, ordered=True)
@@ -280,36 +426,36 @@ def server(input: Inputs, output: Outputs, session: Session):
         match input.filter():
             case "1":
                 outputData = sorted_body.loc[sorted_body["AGE"].isin(input.age()), ("AGE", "LINE", "COMP", input.gene())]
-                outputData["GROUP"] = outputData["AGE"]
+                outputData["GROUP"] = group_codes(outputData, age=True)
                 return outputData
             case "2":
                 outputData = sorted_body.loc[sorted_body["SEX"].isin(input.sex()), ("SEX", "LINE", "COMP", input.gene())]
-                outputData["GROUP"] = outputData["SEX"]
+                outputData["GROUP"] = group_codes(outputData, sex=True)
                 return outputData
             case "3":
                 outputData = sorted_body.loc[sorted_body["LINE"].isin(input.line()), ("LINE", "COMP", input.gene())]
-                outputData["GROUP"] = outputData["LINE"]
+                outputData["GROUP"] = group_codes(outputData, line=True)
                 return outputData
             case "4":
                 outputData = sorted_body.loc[sorted_body["AGE"].isin(input.age()), ("AGE", "SEX", "LINE", "COMP", input.gene())]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["SEX"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, age=True, sex=True)
                 return outputData
             case "5":
                 outputData = sorted_body.loc[sorted_body["AGE"].isin(input.age()), ("AGE", "LINE", "COMP", input.gene())]
                 outputData = outputData.loc[outputData["LINE"].isin(input.line()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["LINE"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, age=True, line=True)
                 return outputData
             case "6":
                 outputData = sorted_body.loc[sorted_body["LINE"].isin(input.line()), ("SEX", "LINE", "COMP", input.gene())]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
-                outputData["GROUP"] = outputData["SEX"].astype(str) + " " + outputData["LINE"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, sex=True, line=True)
                 return outputData
             case "7":
                 outputData = sorted_body.loc[sorted_body["AGE"].isin(input.age()), ("AGE", "SEX", "LINE", "COMP", input.gene())]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
                 outputData = outputData.loc[outputData["LINE"].isin(input.line()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["SEX"].astype(str)  + " " + outputData["LINE"].astype(str) 
+                outputData["GROUP"] = group_codes(outputData, age=True, sex=True, line=True)
                 return outputData
 
     @render_widget
@@ -332,7 +478,7 @@ def server(input: Inputs, output: Outputs, session: Session):
             for group in comp_data['GROUP'].unique():
                 fig.add_trace(go.Box(y = comp_data[comp_data['GROUP'] == group][input.gene()],
                     boxpoints = 'all', jitter = 0.5, marker_line_width=1, line = dict(width=1),
-                    pointpos = 0, name = group, marker_color=color_map[group]),
+                    pointpos = 0, name = group_labels[group], marker_color=group_colors[group]),
                     row=1, col=position)
             position += 1
         fig.update_layout(
@@ -359,7 +505,8 @@ def server(input: Inputs, output: Outputs, session: Session):
 
     @reactive.Calc
     def filtered_tss() -> pd.DataFrame:
-        tss_corr = pq.read_table('ALL_TSS_PER_SAMPLE_TRANSPOSED.parquet', columns=["AGE", "SEX", "LINE", "COMP", input.gene()]).to_pandas()
+        loaded_versions()
+        tss_corr = read_columns('ALL_TSS_PER_SAMPLE_TRANSPOSED.parquet', ["AGE", "SEX", "LINE", "COMP", input.gene()])
         tss_corr["AGE"] = pd.Categorical(tss_corr["AGE"], categories=ages, ordered=True)
         tss_corr["SEX"] = pd.Categorical(tss_corr["SEX"], categories=sexes, ordered=True)
         tss_corr["LINE"] = pd.Categorical(tss_corr["LINE"], categories=lines, ordered=True)
@@ -368,36 +515,36 @@ def server(input: Inputs, output: Outputs, session: Session):
         match input.filter():
             case "1":
                 outputData = sorted_tss.loc[sorted_tss["AGE"].isin(input.age()), ("AGE", "LINE", "COMP", input.gene())]
-                outputData["GROUP"] = outputData["AGE"]
+                outputData["GROUP"] = group_codes(outputData, age=True)
                 return outputData
             case "2":
                 outputData = sorted_tss.loc[sorted_tss["SEX"].isin(input.sex()), ("SEX", "LINE", "COMP", input.gene())]
-                outputData["GROUP"] = outputData["SEX"]
+                outputData["GROUP"] = group_codes(outputData, sex=True)
                 return outputData
             case "3":
                 outputData = sorted_tss.loc[sorted_tss["LINE"].isin(input.line()), ("LINE", "COMP", input.gene())]
-                outputData["GROUP"] = outputData["LINE"]
+                outputData["GROUP"] = group_codes(outputData, line=True)
                 return outputData
             case "4":
                 outputData = sorted_tss.loc[sorted_tss["AGE"].isin(input.age()), ("AGE", "SEX", "LINE", "COMP", input.gene())]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["SEX"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, age=True, sex=True)
                 return outputData
             case "5":
                 outputData = sorted_tss.loc[sorted_tss["AGE"].isin(input.age()), ("AGE", "LINE", "COMP", input.gene())]
                 outputData = outputData.loc[outputData["LINE"].isin(input.line()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["LINE"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, age=True, line=True)
                 return outputData
             case "6":
                 outputData = sorted_tss.loc[sorted_tss["LINE"].isin(input.line()), ("SEX", "LINE", "COMP", input.gene())]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
-                outputData["GROUP"] = outputData["SEX"].astype(str) + " " + outputData["LINE"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, sex=True, line=True)
                 return outputData
             case "7":
                 outputData = sorted_tss.loc[sorted_tss["AGE"].isin(input.age()), ("AGE", "SEX", "LINE", "COMP", input.gene())]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
                 outputData = outputData.loc[outputData["LINE"].isin(input.line()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["SEX"].astype(str)  + " " + outputData["LINE"].astype(str) 
+                outputData["GROUP"] = group_codes(outputData, age=True, sex=True, line=True)
                 return outputData
 
     @render_widget
@@ -420,7 +567,7 @@ def server(input: Inputs, output: Outputs, session: Session):
             for group in comp_data['GROUP'].unique():
                 fig.add_trace(go.Box(y = comp_data[comp_data['GROUP'] == group][input.gene()],
                     boxpoints = 'all', jitter = 0.5, marker_line_width=1, line = dict(width=1),
-                    pointpos = 0, name = group, marker_color=color_map[group]),
+                    pointpos = 0, name = group_labels[group], marker_color=group_colors[group]),
                     row=1, col=position)
             position += 1
         fig.update_layout(
@@ -447,47 +594,51 @@ def server(input: Inputs, output: Outputs, session: Session):
     
     @reactive.Calc
     def filtered_gene_corr() -> pd.DataFrame:
-        rpkm_corr = pq.read_table('ALL_RPKM_DATA_FILTERED_T_v2.parquet', columns=["gene", "AGE", "SEX", "LINE", input.gene()]).to_pandas()
-        gene_corr = pq.read_table('ALL_GENE_BODY_PER_SAMPLE_T_v2.parquet', columns=["gene", "AGE", "SEX", "LINE", "COMP", input.gene()]).to_pandas()
+        loaded_versions()
+        # Taken before reading, so fits are never cached under a newer version than their data
+        version = (data_version('ALL_RPKM_DATA_FILTERED_T_v2.parquet'), data_version('ALL_GENE_BODY_PER_SAMPLE_T_v2.parquet'))
+        rpkm_corr = read_columns('ALL_RPKM_DATA_FILTERED_T_v2.parquet', ["gene", "AGE", "SEX", "LINE", input.gene()])
+        gene_corr = read_columns('ALL_GENE_BODY_PER_SAMPLE_T_v2.parquet', ["gene", "AGE", "SEX", "LINE", "COMP", input.gene()])
         data = pd.merge(rpkm_corr, gene_corr, on = ['gene', 'AGE', 'SEX', 'LINE'])
         data["AGE"] = pd.Categorical(data["AGE"], categories=ages, ordered=True)
         data["SEX"] = pd.Categorical(data["SEX"], categories=sexes, ordered=True)
         data["LINE"] = pd.Categorical(data["LINE"], categories=lines, ordered=True)
         data["COMP"] = pd.Categorical(data["COMP"], categories=comp_order, ordered=True)
         sorted_data = data.sort_values(['LINE', 'AGE', 'SEX', 'COMP'])
+        sorted_data.attrs["version"] = version
         match input.filter():
             case "1":
                 outputData = sorted_data.loc[sorted_data["AGE"].isin(input.age()), ("AGE", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
-                outputData["GROUP"] = outputData["AGE"]
+                outputData["GROUP"] = group_codes(outputData, age=True)
                 return outputData
             case "2":
                 outputData = sorted_data.loc[sorted_data["SEX"].isin(input.sex()), ("SEX", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
-                outputData["GROUP"] = outputData["SEX"]
+                outputData["GROUP"] = group_codes(outputData, sex=True)
                 return outputData
             case "3":
                 outputData = sorted_data.loc[sorted_data["LINE"].isin(input.line()), ("LINE", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
-                outputData["GROUP"] = outputData["LINE"]
+                outputData["GROUP"] = group_codes(outputData, line=True)
                 return outputData
             case "4":
                 outputData = sorted_data.loc[sorted_data["AGE"].isin(input.age()), ("AGE", "SEX", "LINE", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["SEX"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, age=True, sex=True)
                 return outputData
             case "5":
                 outputData = sorted_data.loc[sorted_data["AGE"].isin(input.age()), ("AGE", "LINE", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
                 outputData = outputData.loc[outputData["LINE"].isin(input.line()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["LINE"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, age=True, line=True)
                 return outputData
             case "6":
                 outputData = sorted_data.loc[sorted_data["LINE"].isin(input.line()), ("SEX", "LINE", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
-                outputData["GROUP"] = outputData["SEX"].astype(str) + " " + outputData["LINE"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, sex=True, line=True)
                 return outputData
             case "7":
                 outputData = sorted_data.loc[sorted_data["AGE"].isin(input.age()), ("AGE", "SEX", "LINE", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
                 outputData = outputData.loc[outputData["LINE"].isin(input.line()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["SEX"].astype(str)  + " " + outputData["LINE"].astype(str) 
+                outputData["GROUP"] = group_codes(outputData, age=True, sex=True, line=True)
                 return outputData
 
     @render_widget
@@ -511,28 +662,16 @@ def server(input: Inputs, output: Outputs, session: Session):
 
         for comp in corr_data['COMP'].unique():
             comp_data = corr_data[corr_data['COMP'] == comp]
+            fits = correlation_fits("gene_body", corr_data.attrs["version"], input.gene(), comp, comp_data)
 
             # ---- Scatter points for each group ----
-            for group in comp_data['GROUP'].unique():
-                subset = comp_data[comp_data['GROUP'] == group]
-
-                x = subset[f"{input.gene()}_x"]
-                y = subset[f"{input.gene()}_y"]
-
-                # Remove NaNs and ensure x>0 for log scale
-                mask = x.notna() & y.notna() & (x > 0)
-                x = x[mask]
-                y = y[mask]
-
-                # Floor y values at 0
-                y = np.maximum(y, 0)
-
+            for group, (x, y) in zip(fits["groups"], fits["points"]):
                 fig.add_trace(
                     go.Scatter(
                         x=x,
                         y=y,
-                        name=group,
-                        marker_color=color_map[group],
+                        name=group_labels[group],
+                        marker_color=group_colors[group],
                         mode="markers",
                         legendgroup="test",
                         showlegend=legendKey[position-1]
@@ -541,34 +680,13 @@ def server(input: Inputs, output: Outputs, session: Session):
                     col=position
                 )
 
-            # ---- One regression line across all groups ----
-            x_all = comp_data[f"{input.gene()}_x"]
-            y_all = comp_data[f"{input.gene()}_y"]
-
-            mask_all = x_all.notna() & y_all.notna() & (x_all > 0)
-            x_all = x_all[mask_all]
-            y_all = np.maximum(y_all[mask_all], 0)
-
-            if len(x_all) > 1:
-                x_log = np.log10(x_all)
-                result = linregress(x_log, y_all)
-
-                x_sorted = np.sort(x_all)
-                y_fit = result.slope * np.log10(x_sorted) + result.intercept
-                y_fit = np.maximum(y_fit, 0)  # keep regression line >=0
-
-                fig.add_trace(
-                    go.Scatter(
-                        x=x_sorted,
-                        y=y_fit,
-                        mode="lines",
-                        line=dict(color="black", width=2),
-                        name="Trendline",
-                        showlegend=False
-                    ),
-                    row=1,
-                    col=position
-                )
+            # ---- Regression line per group, or one across all groups ----
+            if input.group_fits():
+                for group, line in zip(fits["groups"], fits["group_lines"]):
+                    if line is not None:
+                        add_trendline(fig, line, group_colors[group], group_labels[group], input.fit_bands(), position)
+            elif fits["pooled_line"] is not None:
+                add_trendline(fig, fits["pooled_line"], "black", "Trendline", input.fit_bands(), position)
 
             position += 1
 
@@ -594,47 +712,51 @@ def server(input: Inputs, output: Outputs, session: Session):
     
     @reactive.Calc
     def filtered_tss_corr() -> pd.DataFrame:
-        rpkm_corr = pq.read_table('ALL_RPKM_DATA_FILTERED_T_v2.parquet', columns=["gene", "AGE", "SEX", "LINE", input.gene()]).to_pandas()
-        tss_corr = pq.read_table('ALL_TSS_PER_SAMPLE_T_v2.parquet', columns=["gene", "AGE", "SEX", "LINE", "COMP", input.gene()]).to_pandas()
+        loaded_versions()
+        # Taken before reading, so fits are never cached under a newer version than their data
+        version = (data_version('ALL_RPKM_DATA_FILTERED_T_v2.parquet'), data_version('ALL_TSS_PER_SAMPLE_T_v2.parquet'))
+        rpkm_corr = read_columns('ALL_RPKM_DATA_FILTERED_T_v2.parquet', ["gene", "AGE", "SEX", "LINE", input.gene()])
+        tss_corr = read_columns('ALL_TSS_PER_SAMPLE_T_v2.parquet', ["gene", "AGE", "SEX", "LINE", "COMP", input.gene()])
         data = pd.merge(rpkm_corr, tss_corr, on = ['gene', 'AGE', 'SEX', 'LINE'])
         data["AGE"] = pd.Categorical(data["AGE"], categories=ages, ordered=True)
         data["SEX"] = pd.Categorical(data["SEX"], categories=sexes, ordered=True)
         data["LINE"] = pd.Categorical(data["LINE"], categories=lines, ordered=True)
         data["COMP"] = pd.Categorical(data["COMP"], categories=comp_order, ordered=True)
         sorted_data = data.sort_values(['LINE', 'AGE', 'SEX', 'COMP'])
+        sorted_data.attrs["version"] = version
         match input.filter():
             case "1":
                 outputData = sorted_data.loc[sorted_data["AGE"].isin(input.age()), ("AGE", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
-                outputData["GROUP"] = outputData["AGE"]
+                outputData["GROUP"] = group_codes(outputData, age=True)
                 return outputData
             case "2":
                 outputData = sorted_data.loc[sorted_data["SEX"].isin(input.sex()), ("SEX", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
-                outputData["GROUP"] = outputData["SEX"]
+                outputData["GROUP"] = group_codes(outputData, sex=True)
                 return outputData
             case "3":
                 outputData = sorted_data.loc[sorted_data["LINE"].isin(input.line()), ("LINE", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
-                outputData["GROUP"] = outputData["LINE"]
+                outputData["GROUP"] = group_codes(outputData, line=True)
                 return outputData
             case "4":
                 outputData = sorted_data.loc[sorted_data["AGE"].isin(input.age()), ("AGE", "SEX", "LINE", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["SEX"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, age=True, sex=True)
                 return outputData
             case "5":
                 outputData = sorted_data.loc[sorted_data["AGE"].isin(input.age()), ("AGE", "LINE", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
                 outputData = outputData.loc[outputData["LINE"].isin(input.line()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["LINE"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, age=True, line=True)
                 return outputData
             case "6":
                 outputData = sorted_data.loc[sorted_data["LINE"].isin(input.line()), ("SEX", "LINE", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
-                outputData["GROUP"] = outputData["SEX"].astype(str) + " " + outputData["LINE"].astype(str)
+                outputData["GROUP"] = group_codes(outputData, sex=True, line=True)
                 return outputData
             case "7":
                 outputData = sorted_data.loc[sorted_data["AGE"].isin(input.age()), ("AGE", "SEX", "LINE", f"{input.gene()}_x", f"{input.gene()}_y", "COMP")]
                 outputData = outputData.loc[outputData["SEX"].isin(input.sex()), ]
                 outputData = outputData.loc[outputData["LINE"].isin(input.line()), ]
-                outputData["GROUP"] = outputData["AGE"].astype(str) + " " + outputData["SEX"].astype(str)  + " " + outputData["LINE"].astype(str) 
+                outputData["GROUP"] = group_codes(outputData, age=True, sex=True, line=True)
                 return outputData
 
     @render_widget
@@ -658,28 +780,16 @@ def server(input: Inputs, output: Outputs, session: Session):
         
         for comp in corr_data['COMP'].unique():
             comp_data = corr_data[corr_data['COMP'] == comp]
+            fits = correlation_fits("tss", corr_data.attrs["version"], input.gene(), comp, comp_data)
 
             # ---- Scatter points for each group ----
-            for group in comp_data['GROUP'].unique():
-                subset = comp_data[comp_data['GROUP'] == group]
-
-                x = subset[f"{input.gene()}_x"]
-                y = subset[f"{input.gene()}_y"]
-
-                # Remove NaNs and ensure x>0 for log scale
-                mask = x.notna() & y.notna() & (x > 0)
-                x = x[mask]
-                y = y[mask]
-
-                # Floor y values at 0
-                y = np.maximum(y, 0)
-
+            for group, (x, y) in zip(fits["groups"], fits["points"]):
                 fig.add_trace(
                     go.Scatter(
                         x=x,
                         y=y,
-                        name=group,
-                        marker_color=color_map[group],
+                        name=group_labels[group],
+                        marker_color=group_colors[group],
                         mode="markers",
                         legendgroup="test",
                         showlegend=legendKey[position-1]
@@ -688,34 +798,13 @@ def server(input: Inputs, output: Outputs, session: Session):
                     col=position
                 )
 
-            # ---- One regression line across all groups ----
-            x_all = comp_data[f"{input.gene()}_x"]
-            y_all = comp_data[f"{input.gene()}_y"]
-
-            mask_all = x_all.notna() & y_all.notna() & (x_all > 0)
-            x_all = x_all[mask_all]
-            y_all = np.maximum(y_all[mask_all], 0)
-
-            if len(x_all) > 1:
-                x_log = np.log10(x_all)
-                result = linregress(x_log, y_all)
-
-                x_sorted = np.sort(x_all)
-                y_fit = result.slope * np.log10(x_sorted) + result.intercept
-                y_fit = np.maximum(y_fit, 0)  # keep regression line >=0
-
-                fig.add_trace(
-                    go.Scatter(
-                        x=x_sorted,
-                        y=y_fit,
-                        mode="lines",
-                        line=dict(color="black", width=2),
-                        name="Trendline",
-                        showlegend=False
-                    ),
-                    row=1,
-                    col=position
-                )
+            # ---- Regression line per group, or one across all groups ----
+            if input.group_fits():
+                for group, line in zip(fits["groups"], fits["group_lines"]):
+                    if line is not None:
+                        add_trendline(fig, line, group_colors[group], group_labels[group], input.fit_bands(), position)
+            elif fits["pooled_line"] is not None:
+                add_trendline(fig, fits["pooled_line"], "black", "Trendline", input.fit_bands(), position)
 
             position += 1
 
@@ -0,0 +1,250 @@
+"""Read-only gene data store shared by every app worker.
+
+`build` converts the parquet datasets into .npy files: string columns
+(AGE, SEX, LINE, COMP, gene) as category codes, and gene values as one
+column-major matrix per dtype so a single gene is a contiguous slice. Workers
+memory-map those files, so every process shares one copy of the data through
+the OS page cache instead of holding its own.
+
+Every dataset is tagged with a version fingerprint of its parquet file. Each
+version is built into its own directory and current.json points workers at
+the live ones, so a replaced parquet file is rebuilt alongside the old copy
+and switched over atomically once it is complete.
+
+When AGING_STORE_DIR is not set (e.g. `shiny run app.py`), `read_columns`
+reads the parquet files directly.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+STORE_ENV = "AGING_STORE_DIR"
+
+# Bumped when the on-disk layout changes so older stores are rebuilt
+STORE_FORMAT = 2
+
+DATASETS = [
+    "ALL_RPKM_LABELED_FILTERED.parquet",
+    "ALL_GENE_BODY_PER_SAMPLE_TRANSPOSED_FINAL.parquet",
+    "ALL_TSS_PER_SAMPLE_TRANSPOSED.parquet",
+    "ALL_RPKM_DATA_FILTERED_T_v2.parquet",
+    "ALL_GENE_BODY_PER_SAMPLE_T_v2.parquet",
+    "ALL_TSS_PER_SAMPLE_T_v2.parquet",
+]
+
+_store = None
+_store_stat = None
+_fingerprints = {}
+_last_versions = {}
+
+def file_version(path):
+    """Fingerprint of a parquet file from its size, mtime and footer metadata.
+
+    The footer is only re-hashed when the file's size or mtime changes.
+    Raises OSError for a missing file or one that is not a complete parquet
+    file yet (e.g. still being copied).
+    """
+    st = os.stat(path)
+    stat = (st.st_size, st.st_mtime_ns)
+    cached = _fingerprints.get(path)
+    if cached is not None and cached[0] == stat:
+        return cached[1]
+    with open(path, "rb") as f:
+        head = f.read(4)
+        if stat[0] < 12 or head != b"PAR1":
+            raise OSError(f"{path} is not a complete parquet file")
+        f.seek(-8, os.SEEK_END)
+        footer_len = int.from_bytes(f.read(4), "little")
+        if f.read(4) != b"PAR1" or footer_len > stat[0] - 12:
+            raise OSError(f"{path} is not a complete parquet file")
+        f.seek(-8 - footer_len, os.SEEK_END)
+        footer = f.read(footer_len)
+    digest = hashlib.sha1(f"{stat[0]}:{stat[1]}:".encode())
+    digest.update(footer)
+    version = digest.hexdigest()[:16]
+    _fingerprints[path] = (stat, version)
+    return version
+
+def _write_dataset(path, target):
+    table = pq.read_table(path)
+    meta = {}
+    genes = {}
+    for field in table.schema:
+        if field.name.startswith("__index_level_"):
+            continue
+        if pa.types.is_floating(field.type) or pa.types.is_integer(field.type):
+            # Same dtype to_pandas() gives: integers with nulls become float64
+            dtype = np.dtype(field.type.to_pandas_dtype())
+            if dtype.kind in "iu" and table.column(field.name).null_count:
+                dtype = np.dtype(np.float64)
+            genes.setdefault(dtype.name, []).append(field.name)
+        else:
+            cat = pd.Categorical(table.column(field.name).to_pandas())
+            np.save(os.path.join(target, f"{field.name}.npy"), cat.codes)
+            meta[field.name] = cat.categories.tolist()
+
+    for dtype, names in genes.items():
+        values = np.empty((table.num_rows, len(names)), dtype=dtype, order="F")
+        for j, gene in enumerate(names):
+            values[:, j] = table.column(gene).to_numpy(zero_copy_only=False)
+        np.save(os.path.join(target, f"values.{dtype}.npy"), values)
+
+    with open(os.path.join(target, "manifest.json"), "w") as f:
+        json.dump({"meta": meta, "genes": genes}, f)
+
+def _read_current(store_dir):
+    try:
+        with open(os.path.join(store_dir, "current.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def build(store_dir, datasets=DATASETS):
+    """Bring store_dir up to date, rebuilding only datasets whose file changed.
+
+    Returns the paths that were switched to a new version.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    current = _read_current(store_dir)
+    previous = dict(current)
+    updated = []
+    for path in datasets:
+        name = os.path.splitext(os.path.basename(path))[0]
+        try:
+            version = file_version(path)
+        except OSError:
+            # Missing or still being copied; keep serving the current version
+            continue
+        entry = f"{name}-{STORE_FORMAT}-{version}"
+        target = os.path.join(store_dir, entry)
+        if current.get(path) == entry and os.path.isdir(target):
+            continue
+        if not os.path.isdir(target):
+            tmp = tempfile.mkdtemp(prefix=f".{entry}-", dir=store_dir)
+            try:
+                _write_dataset(path, tmp)
+            except Exception:
+                shutil.rmtree(tmp)
+                raise
+            try:
+                unchanged = file_version(path) == version
+            except OSError:
+                unchanged = False
+            if not unchanged:
+                # Replaced while we were reading it; pick it up next time
+                shutil.rmtree(tmp)
+                continue
+            os.rename(tmp, target)
+        current[path] = entry
+        updated.append(path)
+
+    if updated:
+        fd, tmp = tempfile.mkstemp(prefix=".current-", dir=store_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(current, f)
+        os.replace(tmp, os.path.join(store_dir, "current.json"))
+
+        # Keep the version workers may still be reading until the next switch
+        keep = set(current.values()) | set(previous.values())
+        for entry in os.listdir(store_dir):
+            full = os.path.join(store_dir, entry)
+            if os.path.isdir(full) and not entry.startswith(".") and entry not in keep:
+                shutil.rmtree(full, ignore_errors=True)
+    return updated
+
+def attach(store_dir, previous=None):
+    """Memory-map the live versions in a built store read-only.
+
+    Datasets whose version matches one in `previous` reuse its mappings.
+    """
+    previous = previous or {}
+    store = {}
+    for path, entry in _read_current(store_dir).items():
+        if path in previous and previous[path]["version"] == entry:
+            store[path] = previous[path]
+            continue
+        target = os.path.join(store_dir, entry)
+        with open(os.path.join(target, "manifest.json")) as f:
+            manifest = json.load(f)
+        store[path] = {
+            "version": entry,
+            "meta": manifest["meta"],
+            "codes": {
+                col: np.load(os.path.join(target, f"{col}.npy"), mmap_mode="r")
+                for col in manifest["meta"]
+            },
+            "index": {
+                gene: (dtype, j)
+                for dtype, names in manifest["genes"].items()
+                for j, gene in enumerate(names)
+            },
+            "values": {
+                dtype: np.load(os.path.join(target, f"values.{dtype}.npy"), mmap_mode="r")
+                for dtype in manifest["genes"]
+            },
+        }
+    return store
+
+def _attached():
+    """Current store snapshot, re-attaching when current.json has changed."""
+    global _store, _store_stat
+    store_dir = os.environ.get(STORE_ENV)
+    if not store_dir:
+        return None
+    st = os.stat(os.path.join(store_dir, "current.json"))
+    stat = (st.st_ino, st.st_mtime_ns)
+    if stat != _store_stat:
+        # Swap in the new snapshot in one assignment; readers holding the
+        # old one keep a consistent view
+        _store = attach(store_dir, _store)
+        _store_stat = stat
+    return _store
+
+def data_version(path):
+    """Version of the data `read_columns(path, ...)` currently serves."""
+    store = _attached()
+    if store is not None and path in store:
+        return store[path]["version"]
+    return file_version(path)
+
+def data_versions():
+    """Versions of every dataset, for polling.
+
+    A file that is missing or still being copied keeps its last known version
+    (None if it has never been readable), so one file being refreshed does not
+    fail the poll for every plot.
+    """
+    versions = []
+    for path in DATASETS:
+        try:
+            _last_versions[path] = data_version(path)
+        except OSError:
+            pass
+        versions.append(_last_versions.get(path))
+    return tuple(versions)
+
+def read_columns(path, columns) -> pd.DataFrame:
+    """Like pq.read_table(path, columns=columns).to_pandas(), from the store.
+
+    Numeric columns keep the dtypes to_pandas() would give; string columns
+    come back as categoricals.
+    """
+    store = _attached()
+    if store is None or path not in store:
+        return pq.read_table(path, columns=columns).to_pandas()
+    entry = store[path]
+    data = {}
+    for col in columns:
+        if col in entry["meta"]:
+            data[col] = pd.Categorical.from_codes(entry["codes"][col], entry["meta"][col])
+        else:
+            dtype, j = entry["index"][col]
+            data[col] = np.array(entry["values"][dtype][:, j])
+    return pd.DataFrame(data)
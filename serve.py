@@ -0,0 +1,67 @@
+"""Run the app on several worker processes sharing one read-only data store.
+
+    python serve.py --workers 4 --port 8001
+
+The parquet datasets are converted once into the memory-mapped store (see
+datastore.py), then one uvicorn process is started per worker on consecutive
+ports (8001, 8002, ...). Every worker attaches to the same store, so adding
+workers adds throughput without another copy of the gene data per process.
+
+Each worker gets its own port rather than sharing one socket through
+`uvicorn --workers`. A Shiny session lives in the process that accepted its
+websocket, and session-scoped HTTP requests such as downloads must reach that
+same process. Put a load balancer with sticky sessions in front of the ports;
+deploy/nginx.conf is an example for the default four workers, and its upstream
+list must be kept in step with --workers and --port.
+
+While the workers run, this process checks the parquet files every
+--interval seconds and rebuilds any that were replaced in the background.
+Workers switch to the new version once it is complete.
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+import uvicorn
+
+import datastore
+
+def run_worker(host, port):
+    uvicorn.run("app:app", host=host, port=port)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=4, help="must match the upstream servers in deploy/nginx.conf")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001, help="port of the first worker")
+    parser.add_argument("--store", default=".store", help="directory for the shared data store")
+    parser.add_argument("--interval", type=float, default=5, help="seconds between checks for replaced data files")
+    args = parser.parse_args()
+
+    datastore.build(args.store)
+    os.environ[datastore.STORE_ENV] = os.path.abspath(args.store)
+
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(args.host, args.port + i))
+        for i in range(args.workers)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        while any(worker.is_alive() for worker in workers):
+            time.sleep(args.interval)
+            try:
+                updated = datastore.build(args.store)
+            except Exception as e:
+                # e.g. a file caught half-copied; the live version keeps serving
+                print(f"Data store rebuild failed, will retry: {e}", flush=True)
+                continue
+            for path in updated:
+                print(f"Reloaded {path}", flush=True)
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+
+if __name__ == "__main__":
+    main()